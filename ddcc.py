@@ -1,26 +1,66 @@
 """
-This script was tested with Python2.7.14, because the core dependency
-(pyasdf) is not yet (04/02/2018) stable under python3.
+This script requires Python 3.
 """
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 import argparse
-import ConfigParser as configparser
+import concurrent.futures
+import configparser
+import functools
+import glob
 import h5py
 import logging
 import mpi4py.MPI as MPI
+import numba
 import numpy as np
 import obspy as op
-import obspy.signal.cross_correlation
 import os
 import pandas as pd
+import scipy.fftpack
+import scipy.signal
+import scipy.spatial
 import signal
-import sys
 import time
 
-WRITER_RANK = 0
-OUTPUT_BLOCK_SIZE = 1000
+# Correlation results are stored in structured arrays with this dtype;
+# each field is written to an output dataset of the same name.
+RESULT_DTYPE = np.dtype([("evidA", "i"),
+                         ("evidB", "i"),
+                         ("sta",   "S5"),
+                         ("chan",  "S6"),
+                         ("phase", "S1"),
+                         ("ddiff", "f"),
+                         ("ccmax", "f")])
+# Output datasets are split into chunks of (at most) this many bytes, which
+# should match the stripe size of the file system.
+OUTPUT_CHUNK_BYTES = 1024 * 1024
+# Each rank appends its results to its own checkpoint file
+# ("<outfile>.<rank>.partial") after every this many primary events, so that
+# a run that is killed can be resumed from them with --resume <outfile>.
+CHECKPOINT_INTERVAL = 10
+# Windows with at least this many samples are correlated in the frequency
+# domain; shorter windows are correlated directly in the time domain.
+FFT_MIN_NSAMP = 128
+# Waveforms are bandpass-filtered with a causal Butterworth filter with this
+# many corners. Only the windows that are correlated are filtered, together
+# with 3*FILTER_CORNERS/fmin seconds of leading data to let the filter
+# settle.
+FILTER_CORNERS = 4
+# MPI-IO hints for writing the output file; these can be overridden with the
+# DDCC_MPIIO_HINTS environment variable ("key1=value1,key2=value2").
+MPIIO_HINTS = {"cb_buffer_size"    : "16777216",
+               "romio_cb_write"    : "enable",
+               "romio_ds_write"    : "disable",
+               "IBM_largeblock_io" : "true"}
+# When running on more than one rank, the manager-rank hands out blocks of
+# (primary event, neighbour event) pairs to the other (worker-) ranks as
+# they become idle. Each block holds all of the pairs of one primary event,
+# so that its waveform data and templates are read and filtered on a single
+# rank. A worker-rank that is interrupted sends back the pairs it has not
+# started with TAG_STOP, and the manager-rank hands them to another one.
+MANAGER_RANK = 0
+TAG_READY, TAG_WORK, TAG_STOP = 1, 2, 3
 
 PROCESSOR_NAME = MPI.Get_processor_name()
 COMM = MPI.COMM_WORLD
@@ -46,6 +86,12 @@ def parse_args():
     parser.add_argument("-c", "--control",
                         type=str,
                         help="HDF5 control file with events to correlate")
+    parser.add_argument("-r", "--resume",
+                        type=str,
+                        help="output file of a previous run; event pairs "
+                             "with results in it, or recorded in the "
+                             "checkpoint files it left behind, are not "
+                             "correlated again")
     parser.add_argument("-l", "--logfile",
                         type=str,
                         help="log file")
@@ -59,28 +105,21 @@ def main(args, cfg):
 
     logger.info("starting process - rank %d" % RANK)
 
-    logger.info("loading event and phase data ")
-    df0_event, df0_phase = load_event_data(args.events_in)
+# Only the first rank reads the event and phase data; the others receive
+# them in a broadcast.
+    if RANK == 0:
+        logger.info("loading event and phase data ")
+        if args.control is not None:
+            logger.info("using control file %s" % args.control)
+        event, phase = load_event_data(args.events_in, control=args.control)
+    else:
+        event, phase = None, None
+    event, phase = bcast_array(event), bcast_array(phase)
     logger.info("event and phase data loaded")
 
-    if args.control is not None:
-        logger.info("using control file %s" % args.control)
-        with pd.HDFStore(args.control, mode="r") as control:
-            control_list = control["events"]
-            df0_event = df0_event[df0_event.index.isin(control_list)]
-    else:
-        control_list = df0_event.index
-
-    if RANK == WRITER_RANK:
-# Send assignment to each worker-rank.
-        for _rank, _data in zip([i for i in range(SIZE) if i != WRITER_RANK],
-                                np.array_split(control_list, SIZE-1)):
-            COMM.send(_data, _rank)
-# Enter the output loop and exit at the end.
-        with h5py.File(args.outfile, "w") as f5:
-            initialize_output(f5)
-            write_loop(f5)
-        exit()
+    logger.info("building event and phase indexes")
+    event_index = build_event_index(event)
+    phase_index = build_phase_index(phase)
 
 # Configure the HDF5 cache.
     cache_config = (cfg["cache_mdc"],
@@ -90,31 +129,223 @@ def main(args, cfg):
     logger.info("setting HDF5 cache configuration - (%d, %d, %d, %.2f)" % cache_config)
     propfaid = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
     propfaid.set_cache(*cache_config)
+# Start the metadata cache at its maximum size, and keep unused entries for
+# as many epochs as HDF5 allows, so that the reference groups of the
+# waveform file are read only once.
+    logger.info("setting HDF5 metadata cache size - %d" % cfg["cache_mdc_nbytes"])
+    mdc_config = propfaid.get_mdc_config()
+    mdc_config.set_initial_size = True
+    mdc_config.initial_size = cfg["cache_mdc_nbytes"]
+    mdc_config.max_size = cfg["cache_mdc_nbytes"]
+    mdc_config.epochs_before_eviction = 10
+    propfaid.set_mdc_config(mdc_config)
+# results    :: arrays of correlation results from this rank, one per pair
+# attempted  :: arrays of the event pairs that results came from, including
+#               pairs without any result
+# nflushed   :: number of arrays in results already in the checkpoint file
+# checkpoint :: file this rank appends its results to as it goes, so that
+#               an interrupted run can be resumed
+# data       :: (primary event ID, neighbour event ID) pairs to correlate on
+#               this rank
+# completed  :: whether this rank got through all of its pairs
+    results, attempted, nflushed = [], [], 0
+    checkpoint = "%s.%d.partial" % (args.outfile, RANK)
+    data, dispatched, started, nskipped, fid = iter([]), False, False, 0, None
+    completed = False
     try:
-        fid = h5py.h5f.open(args.wfs_in,
+        if RANK == MANAGER_RANK:
+            pairs = get_pairs(event_index, k=cfg["knn"])
+            if args.resume is not None:
+# Carry over the results of the previous run and only correlate the pairs
+# it did not get to.
+                logger.info("resuming from %s" % args.resume)
+                previous, previous_pairs = load_previous_results(args.resume)
+                results.append(previous)
+                attempted.append(previous_pairs)
+                done = set(map(tuple, previous_pairs.tolist()))
+                pairs = pairs[np.array([tuple(pair) not in done for pair in pairs.tolist()],
+                                       dtype=bool)]
+                logger.info("%d event pairs left to correlate" % len(pairs))
+# The carried-over results are kept in the checkpoint file of the
+# manager-rank until the output is written.
+            start_checkpoints(args.outfile, checkpoint, results, attempted)
+            nflushed, started = len(results), True
+        if SIZE == 1:
+            data = iter(pairs)
+        elif RANK == MANAGER_RANK:
+            logger.info("handing out %d event pairs" % len(pairs))
+            dispatched = True
+            dispatch_work(pairs)
+        else:
+            data = request_work()
+# Worker-ranks make MPI calls in request_work() while waveform data are
+# read in the background, which is only allowed if the MPI library
+# supports calls from several threads at once.
+        prefetch = MPI.Query_thread() == MPI.THREAD_MULTIPLE
+        if not prefetch:
+            logger.info("MPI library is not thread-safe; not prefetching "
+                        "waveform data")
+        fid = h5py.h5f.open(os.fsencode(args.wfs_in),
                             flags=h5py.h5f.ACC_RDONLY,
                             fapl=propfaid)
-        with h5py.File(fid, mode="r", driver="mpio", comm=COMM) as asdf_h5:
-            logger.info("receiving scattered data")
-            data = COMM.recv()
-
-            for evid in data:
-                logger.debug("correlating %d" % evid)
+        with h5py.File(fid, mode="r", driver="mpio", comm=COMM) as asdf_h5,\
+                concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetcher:
+# cache, templates, spectra ::
+#                   waveform data, template windows and template spectra,
+#                   kept for as long as consecutive pairs share the same
+#                   primary event
+# pending        :: the next pair; its waveform data are read in the
+#                   background while the current pair is correlated. h5py
+#                   holds the GIL while it reads, so reads only overlap
+#                   with the parts of the correlation that release it,
+#                   such as xcorr_direct(). Only pairs after the first of
+#                   each primary event are prefetched, and only if
+#                   prefetch is set.
+# nevent         :: number of primary events started on this rank
+            evid0_cached, cache, templates, spectra = None, {}, {}, {}
+            nevent = 0
+            pending = next(data, None)
+            while pending is not None and not INTERRUPTED:
+                (evid0, evidB), pending = pending, next(data, None)
+                if evid0 != evid0_cached:
+                    evid0_cached, cache, templates, spectra = evid0, {}, {}, {}
+                    nevent += 1
+                    if nevent % CHECKPOINT_INTERVAL == 0:
+                        write_checkpoint(checkpoint,
+                                         results[nflushed:],
+                                         attempted[nflushed:])
+                        nflushed = len(results)
+                if prefetch and pending is not None and pending[0] == evid0:
+                    prefetch_station_data(asdf_h5,
+                                          pending,
+                                          phase_index,
+                                          cache,
+                                          prefetcher)
                 try:
-                    correlate(evid, asdf_h5, df0_event, df0_phase, cfg)
+                    results.append(correlate_pair(evid0,
+                                                  evidB,
+                                                  asdf_h5,
+                                                  event_index,
+                                                  phase_index,
+                                                  cfg,
+                                                  cache,
+                                                  templates,
+                                                  spectra))
+                    attempted.append(np.array([[evid0, evidB]], dtype=np.int64))
                 except Exception as err:
                     logger.error(err)
-            logger.info("successfully completed correlation")
+            if INTERRUPTED:
+                logger.warning("interrupting signal received... stopping")
+                nskipped += int(pending is not None)
+            else:
+                completed = True
+                logger.info("successfully completed correlation")
     except Exception as err:
         logger.error(err)
-        fid.close()
+        if fid is not None and fid.valid:
+            fid.close()
     finally:
-# Send a signal to the writer-rank that this worker-rank has finished.
-        COMM.send(StopIteration, WRITER_RANK)
+# If the manager-rank failed before handing out any work, tell the
+# worker-ranks to stop. A worker-rank that failed keeps requesting work
+# until the manager-rank runs out, so that it is not left waiting for it;
+# an interrupted one stops requesting work (see request_work()).
+        if SIZE > 1 and RANK == MANAGER_RANK and not dispatched:
+            dispatch_work(np.empty((0, 2), dtype=np.int64))
+        nskipped += sum(1 for pair in data)
+        if nskipped > 0:
+            logger.warning("skipped %d event pairs" % nskipped)
+        write_checkpoint(checkpoint, results[nflushed:], attempted[nflushed:])
+# Every rank has to take part in writing the output, even if it failed.
+        completed = COMM.allreduce(int(completed and nskipped == 0),
+                                   op=MPI.MIN) == 1
+        results = np.concatenate(results) if len(results) > 0\
+                  else np.empty(0, dtype=RESULT_DTYPE)
+        logger.info("writing %d results to %s" % (len(results), args.outfile))
+        write_output(args.outfile,
+                     results,
+                     cfg["mpiio_hints"],
+                     cfg["output_gzip_level"])
+# The checkpoint files are only needed to resume a run that did not get
+# through all of its pairs: they also record the pairs without results.
+        if RANK == MANAGER_RANK and started and completed:
+            for f5 in glob.glob(args.outfile + ".*.partial"):
+                os.remove(f5)
+
+def dispatch_work(pairs):
+    """
+    Hand out blocks of event pairs to worker-ranks as they request work,
+    one primary event per block, then tell each worker-rank to stop by
+    sending it an empty block. Pairs sent back by an interrupted
+    worker-rank are handed out again. No more work is handed out once an
+    interrupting signal is received. Blocks are sent as raw buffers, not
+    pickled.
+
+    pairs :: 2-D int64 array of event ID pairs returned by get_pairs(),
+             sorted by primary event.
+    """
+    status = MPI.Status()
+    pairs = np.ascontiguousarray(pairs, dtype=np.int64)
+    blocks = iter(np.split(pairs, np.flatnonzero(np.diff(pairs[:, 0])) + 1))
+    returned, nstopped = [], 0
+    while nstopped < SIZE-1:
+        COMM.Probe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+        source, tag = status.Get_source(), status.Get_tag()
+        message = np.empty((status.Get_count(MPI.INT64_T) // 2, 2), dtype=np.int64)
+        COMM.Recv([message, MPI.INT64_T], source=source, tag=tag)
+        if tag == TAG_STOP:
+            if len(message) > 0:
+                returned.append(message)
+            nstopped += 1
+            continue
+        if INTERRUPTED:
+            block = pairs[:0]
+        elif len(returned) > 0:
+            block = returned.pop()
+        else:
+            block = next(blocks, pairs[:0])
+        if len(block) == 0:
+            nstopped += 1
+        COMM.Send([block, MPI.INT64_T], dest=source, tag=TAG_WORK)
+    nleft = sum(map(len, returned)) + sum(map(len, blocks))
+    if nleft > 0:
+        logger.warning("%d event pairs were not handed out" % nleft)
+
+def request_work():
+    """
+    Request blocks of event pairs from the manager-rank until it has none
+    left. Once an interrupting signal is received, send the pairs of the
+    current block that have not been handed out yet back to the
+    manager-rank instead, which also tells it that this rank stops.
+
+    Returns:
+    A generator of event ID pairs.
+    """
+    status = MPI.Status()
+    block = np.empty((0, 2), dtype=np.int64)
+    while not INTERRUPTED:
+        COMM.Send([np.empty(0, dtype=np.int64), MPI.INT64_T],
+                  dest=MANAGER_RANK,
+                  tag=TAG_READY)
+        COMM.Probe(source=MANAGER_RANK, tag=TAG_WORK, status=status)
+        block = np.empty((status.Get_count(MPI.INT64_T) // 2, 2), dtype=np.int64)
+        COMM.Recv([block, MPI.INT64_T], source=MANAGER_RANK, tag=TAG_WORK)
+        if len(block) == 0:
+            return
+        for i in range(len(block)):
+            if INTERRUPTED:
+                block = block[i:]
+                break
+            yield block[i]
+        else:
+            block = block[:0]
+    COMM.Send([np.ascontiguousarray(block), MPI.INT64_T],
+              dest=MANAGER_RANK,
+              tag=TAG_STOP)
 
 def parse_config(config_file):
     parser = configparser.ConfigParser()
-    parser.readfp(open(config_file))
+    with open(config_file) as cfg_file:
+        parser.read_file(cfg_file)
     config = {"tlead_p"           : parser.getfloat("general", "tlead_p"),
               "tlead_s"           : parser.getfloat("general", "tlead_s"),
               "tlag_p"            : parser.getfloat("general", "tlag_p"),
@@ -126,7 +357,16 @@ def parse_config(config_file):
               "cache_mdc"         : parser.getint(  "hdf5-cache", "mdc"),
               "cache_rdcc"        : parser.getint(  "hdf5-cache", "rdcc"),
               "cache_rdcc_nbytes" : parser.getint(  "hdf5-cache", "rdcc_nbytes"),
-              "cache_rdcc_w0"     : parser.getfloat("hdf5-cache", "rdcc_w0")}
+              "cache_rdcc_w0"     : parser.getfloat("hdf5-cache", "rdcc_w0"),
+              "cache_mdc_nbytes"  : parser.getint(  "hdf5-cache", "mdc_nbytes",
+                                                  fallback=32*1024*1024),
+              "output_gzip_level" : parser.getint(  "output",  "gzip_level",
+                                                  fallback=0)}
+    config["mpiio_hints"] = dict(MPIIO_HINTS)
+    config["mpiio_hints"].update(hint.split("=", 1)
+                                 for hint in os.environ.get("DDCC_MPIIO_HINTS",
+                                                            "").split(",")
+                                 if "=" in hint)
     return(config)
 
 
@@ -160,313 +400,945 @@ def configure_logging(verbose, logfile):
         stream_handler.setFormatter(formatter)
         logger.addHandler(stream_handler)
 
-def load_event_data(f5in, evids=None):
+def load_event_data(f5in, control=None):
+    """
+    Load event and phase data.
+
+    f5in    :: input event/phase data HDFStore.
+    control :: HDF5 control file with events to correlate. If given,
+               only these events and their phase data are loaded.
+
+    Returns:
+    event :: record array of events with fields evid, lat, lon, depth,
+             and time.
+    phase :: record array of phase data with fields evid, net, sta, chan,
+             phase, and time.
+    Times are POSIX timestamps and string fields have a fixed width.
+    """
     with pd.HDFStore(f5in, mode="r") as cat:
-        if evids is None:
-            return(cat["event"], cat["phase"])
-        else:
-            return(cat["event"].loc[evids], cat["phase"].loc[evids])
+        df_event, df_phase = cat["event"], cat["phase"]
+    if control is not None:
+        with pd.HDFStore(control, mode="r") as f5:
+            df_event = df_event[df_event.index.isin(f5["events"])]
+    df_phase = df_phase[df_phase.index.isin(df_event.index)]
+    event = np.rec.fromarrays([df_event.index.values,
+                               df_event["lat"].values,
+                               df_event["lon"].values,
+                               df_event["depth"].values,
+                               get_timestamps(df_event["time"].values)],
+                              names="evid,lat,lon,depth,time")
+    phase = np.rec.fromarrays([df_phase.index.values,
+                               df_phase["net"].values.astype(str),
+                               df_phase["sta"].values.astype(str),
+                               df_phase["chan"].values.astype(str),
+                               df_phase["phase"].values.astype(str),
+                               get_timestamps(df_phase["time"].values)],
+                              names="evid,net,sta,chan,phase,time")
+    return(event, phase)
+
+def bcast_array(arr, root=0):
+    """
+    Broadcast a NumPy array from the root rank to all ranks. Only the
+    dtype and shape are pickled; the data are sent as a raw buffer.
+
+    arr  :: array to broadcast; ignored on all but the root rank.
+    root :: rank to broadcast from.
+
+    Returns:
+    The broadcast array.
+    """
+    dtype, shape = COMM.bcast((arr.dtype, arr.shape) if RANK == root else None,
+                              root=root)
+    if RANK != root:
+        arr = np.empty(shape, dtype=dtype)
+    COMM.Bcast([np.ascontiguousarray(arr), MPI.BYTE], root=root)
+    return(arr)
+
+@functools.lru_cache(maxsize=4096)
+def get_references(asdf_h5, ref, net, sta):
+    """
+    Get the waveform references of an event at a station. The result is
+    cached, so the reference groups of each event and station are only
+    traversed once, no matter how many pairs the event takes part in.
+
+    asdf_h5 :: h5py.File of the ASDF waveform dataset.
+    ref     :: reference label ("event$EVID").
+    net     :: network code.
+    sta     :: station code.
 
-def get_waveforms_for_reference(asdf_h5, ref, net, sta):
-    _st = op.Stream()
+    Returns:
+    A tuple of (location, channel, reference_path, i0, i1,
+    sampling_rate, starttime) tuples, one for each channel, where
+    reference_path is the path of the waveform dataset, i0:i1 the slice
+    of samples referenced, and starttime a POSIX timestamp. The tuple is
+    empty if there are no data.
+    """
+    _refs = []
     _label = "/".join(("/References", ref, net, sta))
-    for _loc in asdf_h5[_label]:
-        for _chan in asdf_h5["/".join((_label, _loc))]:
-            _handle = "/".join((_label, _loc, _chan))
-            _ref = asdf_h5[_handle]
-            _ds = asdf_h5[_ref.attrs["reference_path"]]
-            _tr                  = op.Trace(data=_ds[_ref[0]: _ref[1]])
-            _tr.stats.delta      = 1./_ds.attrs["sampling_rate"]
-            _tr.stats.starttime  = op.UTCDateTime(_ref.attrs["starttime"]*1e-9)
-            _tr.stats.network    = net
-            _tr.stats.station    = sta
-            _tr.stats.location   = _loc if _loc != "__" else ""
-            _tr.stats.channel    = _chan
-            _st.append(_tr)
-    return(_st)
-
-def get_knn(evid, df_event, k=10):
+    if _label not in asdf_h5:
+        return(())
+    # Walk the reference groups from their parents instead of resolving
+    # every path from the root group.
+    for _loc, _loc_group in asdf_h5[_label].items():
+        for _chan, _ref in _loc_group.items():
+            _path = _ref.attrs["reference_path"]
+            _i0, _i1 = _ref[:2]
+            _refs.append((_loc if _loc != "__" else "",
+                          _chan,
+                          _path,
+                          _i0,
+                          _i1,
+                          asdf_h5[_path].attrs["sampling_rate"],
+                          _ref.attrs["starttime"]*1e-9))
+    return(tuple(_refs))
+
+def get_station_data(asdf_h5, evid, net, sta, cache):
+    """
+    Get (unfiltered) waveform data for an event at a station.
+
+    asdf_h5 :: h5py.File of the ASDF waveform dataset.
+    evid    :: event ID.
+    net     :: network code.
+    sta     :: station code.
+    cache   :: dict of previously retrieved data, or of futures of data
+               being read by prefetch_station_data(), which is updated in
+               place.
+
+    Returns:
+    A dict mapping channel codes to (data, starttime, sampling_rate)
+    tuples, where data is a NumPy array and starttime is a POSIX
+    timestamp. The dict is empty if there are no data.
+    """
+    key = (evid, net, sta)
+    if key not in cache:
+        cache[key] = read_station_data(asdf_h5, evid, net, sta)
+    elif isinstance(cache[key], concurrent.futures.Future):
+        cache[key] = cache[key].result()
+    return(cache[key])
+
+def prefetch_station_data(asdf_h5, evids, phase_index, cache, executor):
+    """
+    Start reading the waveform data needed to correlate a pair of events
+    in the background. The futures are stored in the cache, where
+    get_station_data() picks them up. The reads hold the GIL, so they
+    run alongside the caller only while it is in code that releases
+    the GIL.
+
+    asdf_h5     :: h5py.File of the ASDF waveform dataset.
+    evids       :: (primary event ID, secondary event ID) pair.
+    phase_index :: phase index returned by build_phase_index().
+    cache       :: cache passed to get_station_data(), which is updated
+                   in place.
+    executor    :: concurrent.futures.Executor to read the data with.
+    """
+    __phase = get_phases(evids, phase_index, unique=True)
+    for net, sta in zip(__phase["net"].tolist(), __phase["sta"].tolist()):
+        # The primary event is already known to have no data here, so the
+        # secondary event's data will not be needed.
+        if cache.get((evids[0], net, sta)) == {}:
+            continue
+        for evid in evids:
+            if (evid, net, sta) not in cache:
+                cache[(evid, net, sta)] = executor.submit(read_station_data,
+                                                          asdf_h5,
+                                                          evid,
+                                                          net,
+                                                          sta)
+
+def read_station_data(asdf_h5, evid, net, sta):
+    """
+    Read (unfiltered) waveform data for an event at a station.
+
+    asdf_h5 :: h5py.File of the ASDF waveform dataset.
+    evid    :: event ID.
+    net     :: network code.
+    sta     :: station code.
+
+    Returns:
+    A dict of waveform data as returned by get_station_data().
+    """
+    # The samples are read straight into arrays of the stored dtype,
+    # without building ObsPy Traces around them.
+    waves = {}
+    try:
+        for _, chan, path, i0, i1, sampling_rate, starttime\
+                in get_references(asdf_h5, "event%d" % evid, net, sta):
+            if chan in waves or i1 <= i0:
+                continue
+            dset = asdf_h5[path]
+            data = np.empty(i1 - i0, dtype=dset.dtype)
+            dset.read_direct(data, source_sel=np.s_[i0: i1])
+            waves[chan] = (data, starttime, sampling_rate)
+    except KeyError as err:
+        waves = {}
+    return(waves)
+
+@functools.lru_cache(maxsize=None)
+def get_bandpass_sos(fs, fmin, fmax, corners=FILTER_CORNERS):
+    """
+    Design a Butterworth bandpass filter. The result is cached, so the
+    filter is only designed once for each sampling rate.
+    Applying the filter with scipy.signal.sosfilt is equivalent to
+    obspy.Trace.filter("bandpass", ...), which also falls back to a
+    highpass filter if fmax is at or above the Nyquist frequency.
+
+    fs      :: sampling rate.
+    fmin    :: low corner frequency.
+    fmax    :: high corner frequency.
+    corners :: number of corners.
+
+    Returns:
+    Second-order sections of the filter.
+    """
+    fnyq = 0.5 * fs
+    if fmax / fnyq - 1.0 > -1e-6:
+        logger.warning("high corner frequency (%.2f) is at or above Nyquist "
+                       "(%.2f); applying a highpass filter instead" % (fmax,
+                                                                      fnyq))
+        return(scipy.signal.iirfilter(corners,
+                                      fmin / fnyq,
+                                      btype="highpass",
+                                      ftype="butter",
+                                      output="sos"))
+    return(scipy.signal.iirfilter(corners,
+                                  [fmin / fnyq, fmax / fnyq],
+                                  btype="band",
+                                  ftype="butter",
+                                  output="sos"))
+
+def get_window(trace, reftime, tlead, tlag, cfg):
+    """
+    Get a window of bandpass-filtered samples around a given time.
+    Only the window and the data needed for the filter to settle are
+    filtered.
+
+    trace   :: (data, starttime, sampling_rate) tuple returned by
+               get_station_data().
+    reftime :: POSIX timestamp of the reference time.
+    tlead   :: number of seconds before the reference time.
+    tlag    :: number of seconds after the reference time.
+    cfg     :: configuration dict returned by parse_config().
+
+    Returns:
+    A float32 array of int(round((tlead+tlag)*sampling_rate))+1 samples
+    starting at the sample nearest to reftime-tlead, or None if the data do
+    not cover the window.
+    """
+    data, starttime, sampling_rate = trace
+    nsamp, npad, sos = get_window_spec(tlead,
+                                       tlag,
+                                       sampling_rate,
+                                       cfg["filter_fmin"],
+                                       cfg["filter_fmax"])
+    i0 = int(round((reftime - tlead - starttime) * sampling_rate))
+    if i0 < 0 or i0 + nsamp > len(data):
+        return(None)
+    npad = min(i0, npad)
+    return(scipy.signal.sosfilt(sos, data[i0-npad: i0+nsamp])[npad:]\
+           .astype(np.float32))
+
+@functools.lru_cache(maxsize=None)
+def get_window_spec(tlead, tlag, sampling_rate, fmin, fmax):
+    """
+    Get the parameters of get_window() that only depend on the phase and
+    the sampling rate. The result is cached, so they are only computed
+    once for each phase and sampling rate.
+
+    tlead         :: number of seconds before the reference time.
+    tlag          :: number of seconds after the reference time.
+    sampling_rate :: sampling rate.
+    fmin          :: bandpass filter low corner frequency.
+    fmax          :: bandpass filter high corner frequency.
+
+    Returns:
+    nsamp :: number of samples in the window.
+    npad  :: number of leading samples to filter for the filter to
+             settle; the filter is causal, so no trailing samples are
+             needed.
+    sos   :: second-order sections returned by get_bandpass_sos().
+    """
+    nsamp = int(round((tlead + tlag) * sampling_rate)) + 1
+    npad = int(np.ceil(3 * FILTER_CORNERS / fmin * sampling_rate))
+    return(nsamp, npad, get_bandpass_sos(sampling_rate, fmin, fmax))
+
+def get_timestamps(times):
+    """
+    Convert times to POSIX timestamps.
+
+    times :: array of times in any format understood by
+             obspy.UTCDateTime.
+
+    Returns:
+    A float64 array of POSIX timestamps.
+    """
+    times = np.asarray(times)
+    # Numeric times are already timestamps. UTCDateTime misreads
+    # numpy.datetime64 values, so those are converted directly.
+    if times.dtype.kind in "iuf":
+        return(times.astype(np.float64))
+    if times.dtype.kind == "M":
+        return(times.astype("datetime64[ns]").astype(np.int64) / 1e9)
+    return(np.array([op.UTCDateTime(t).timestamp for t in times],
+                    dtype=np.float64))
+
+def build_event_index(event):
+    """
+    Build a spatial index of events for nearest-neighbour queries.
+
+    event :: record array of events returned by load_event_data().
+
+    Returns:
+    A dict with the following items, where arrays are sorted by event ID:
+    evid :: array of event IDs.
+    time :: array of origin times as POSIX timestamps.
+    tree :: scipy.spatial.cKDTree of event coordinates (in km).
+    """
+    event = event[np.argsort(event["evid"])]
+    coords = np.column_stack([event["lat"] * 111.11,
+                              event["lon"] * 111.11,
+                              event["depth"]])
+    return({"evid": event["evid"],
+            "time": event["time"],
+            "tree": scipy.spatial.cKDTree(coords)})
+
+def build_phase_index(phase):
+    """
+    Build an index of phase data by event ID.
+
+    phase :: record array of phase data returned by load_event_data().
+
+    Returns:
+    A dict with the following items:
+    phase :: record array of all phase data, sorted by event ID, station,
+             and phase, with fields evid, net, sta, chan, phase, and time.
+             String fields have a fixed width and arrival times are POSIX
+             timestamps.
+    slice :: dict mapping each event ID to the slice of phase holding
+             its phase data.
+    """
+    rec = phase[np.lexsort((phase["phase"], phase["sta"], phase["evid"]))]
+    evids, start = np.unique(rec["evid"], return_index=True)
+    stop = np.append(start[1:], len(rec))
+    return({"phase": rec,
+            "slice": dict((evid, slice(i0, i1))
+                          for evid, i0, i1 in zip(evids, start, stop))})
+
+def get_knn(evid, event_index, k=10):
     """
     Get the K nearest-neighbour events.
     Only returns events with IDs greater than evid.
 
-    evid :: event ID of primary event.
-    k    :: number of nearest-neighbours to retrieve.
+    evid        :: event ID of primary event.
+    event_index :: event index returned by build_event_index().
+    k           :: number of nearest-neighbours to retrieve.
+
+    Returns:
+    Positions in event_index of the primary event followed by its
+    nearest-neighbours, sorted by distance.
+    """
+    evids, tree = event_index["evid"], event_index["tree"]
+    i0 = np.searchsorted(evids, evid)
+    if i0 == len(evids) or evids[i0] != evid:
+        raise(KeyError(evid))
+    # Only events after the primary event qualify, so query the tree for
+    # more neighbours than needed.
+    nquery = min(2 * (k+1), len(evids))
+    _, idx = tree.query(tree.data[i0], k=nquery)
+    idx = np.atleast_1d(idx)
+    idx = idx[idx > i0][:k]
+    if len(idx) < k and nquery < len(evids):
+    # Too few of the nearest events qualify, so search all qualifying
+    # events directly; only the k nearest are partitioned and sorted.
+        diff = tree.data[i0+1:] - tree.data[i0]
+        dist2 = np.einsum("ij,ij->i", diff, diff)
+        idx = np.argpartition(dist2, k)[:k] if len(dist2) > k\
+              else np.arange(len(dist2))
+        idx = i0 + 1 + idx[np.argsort(dist2[idx])]
+    return(np.concatenate([[i0], idx]))
+
+def get_pairs(event_index, k=10):
+    """
+    Get every (primary event, neighbour event) pair to correlate.
+
+    event_index :: event index returned by build_event_index().
+    k           :: number of nearest-neighbours of each primary event.
+
+    Returns:
+    A 2-D array of event ID pairs, one pair per row, sorted by primary
+    event ID and then by distance.
     """
-    lat0, lon0, depth0, time0 = df_event.loc[evid][["lat", "lon", "depth", "time"]]
-    _df = df_event.copy()
-    _df = _df[_df.index >= evid]
-    _df["distance"] = np.sqrt(
-        (np.square(_df["lat"]-lat0) + np.square(_df["lon"]-lon0))*111.11**2
-        +np.square(_df["depth"]-depth0)
-    )
-    return(_df.sort_values("distance").iloc[:k+1])
+    evids = event_index["evid"]
+    pairs = [np.column_stack((np.repeat(evids[knn[0]], len(knn)-1),
+                              evids[knn[1:]]))
+             for knn in (get_knn(evid, event_index, k=k) for evid in evids)]
+    return(np.concatenate([np.empty((0, 2), dtype=np.int64)] + pairs)\
+             .astype(np.int64))
 
-def get_phases(evids, df_phase):
+def get_phases(evids, phase_index, unique=False):
     """
     Get phase data for a set of events.
 
-    evids :: list of event IDs to retrieve phase data for.
+    evids       :: list of event IDs to retrieve phase data for.
+    phase_index :: phase index returned by build_phase_index().
+    unique      :: only keep the first arrival of each station:phase
+                   pair.
+
+    Returns:
+    A record array of phase data sorted by station and phase, and by
+    the order of evids within each station:phase pair.
+    """
+    rec = np.concatenate([phase_index["phase"][:0]]
+                       + [phase_index["phase"][phase_index["slice"][evid]]
+                          for evid in evids if evid in phase_index["slice"]])
+    rec = rec[np.lexsort((rec["phase"], rec["sta"]))]
+    if unique is True:
+        keep = np.ones(len(rec), dtype=bool)
+        keep[1:] = (rec["sta"][1:] != rec["sta"][:-1])\
+                 | (rec["phase"][1:] != rec["phase"][:-1])
+        rec = rec[keep]
+    return(rec)
+
+@functools.lru_cache(maxsize=None)
+def get_fft_len(nsamp):
+    """
+    Get the FFT length used to cross-correlate traces of nsamp samples.
+    The result is cached, so it is only computed once for each window
+    length.
+
+    nsamp :: number of samples in each trace.
+
+    Returns:
+    The smallest fast FFT length of at least 2*nsamp-1 samples.
+    """
+    return(scipy.fftpack.next_fast_len(2*nsamp-1))
+
+def template_spectrum(x):
+    """
+    Compute the spectrum of a template trace for xcorr_fft().
+    The spectrum only depends on the template, so it can be reused for
+    every test trace correlated with it.
+
+    x :: 1-D array of template trace.
+
+    Returns:
+    spectrum :: complex conjugate of the rFFT of the demeaned trace,
+                zero-padded to the length used by xcorr_fft().
+    norm     :: L2 norm of the demeaned trace.
+    """
+    x = x - x.mean()
+    nfft = get_fft_len(len(x))
+    return(np.conj(np.fft.rfft(x, n=nfft)), np.sqrt(np.sum(x**2)))
+
+def xcorr_fft(Y, Xf, xnorm, max_shift):
+    """
+    Cross-correlate a batch of equal-length traces in the frequency
+    domain.
+    Equivalent to obspy.signal.cross_correlation.correlate (demeaned
+    and normalized) followed by xcorr_max, applied row by row.
+
+    Y         :: 2-D array of "test" traces, one trace per row.
+    Xf        :: 2-D array of "template" spectra returned by
+                 template_spectrum(), one for each row of Y. Templates
+                 must be as long as the test traces.
+    xnorm     :: array of template norms returned by template_spectrum().
+    max_shift :: maximum shift (in samples) to apply.
+
+    Returns:
+    clag  :: array of lags (in samples) of the maximum absolute
+             cross-correlation coefficient for each row.
+    ccmax :: array of the corresponding cross-correlation coefficients.
+    """
+    Y = Y - Y.mean(axis=1)[:, np.newaxis]
+    nfft = get_fft_len(Y.shape[1])
+    corr = np.fft.irfft(np.fft.rfft(Y, n=nfft, axis=1) * Xf,
+                        n=nfft,
+                        axis=1)
+    # Keep only lags from -max_shift to +max_shift.
+    corr = np.hstack([corr[:, nfft-max_shift:], corr[:, :max_shift+1]])
+    norm = np.sqrt(np.sum(Y**2, axis=1)) * xnorm
+    norm[norm == 0] = 1
+    corr /= norm[:, np.newaxis]
+    idxmax = np.argmax(np.abs(corr), axis=1)
+    return(idxmax - max_shift, corr[np.arange(len(corr)), idxmax])
+
+# The kernel is serial because one MPI rank already runs per core, and it
+# releases the GIL so that other threads can run while it does.
+@numba.njit("Tuple((int64[:], float32[:]))(float32[:, ::1], float32[:, ::1], int64)",
+            nogil=True,
+            fastmath=True,
+            cache=True)
+def xcorr_direct(Y, X, max_shift):
     """
-    return(
-        df_phase[
-            df_phase.index.isin(evids)
-        ].sort_index(
-        ).sort_values(["sta", "phase"])
-    )
+    Cross-correlate a batch of equal-length traces in the time domain.
+    Returns the same values as xcorr_fft(), but is faster for short
+    windows.
 
-def correlate(evid, asdf_h5, df0_event, df0_phase, cfg):
+    Y         :: 2-D float32 array of "test" traces, one trace per row.
+    X         :: 2-D float32 array of "template" traces with the same
+                 shape as Y.
+    max_shift :: maximum shift (in samples) to apply.
+
+    Returns:
+    clag  :: array of lags (in samples) of the maximum absolute
+             cross-correlation coefficient for each row.
+    ccmax :: float32 array of the corresponding cross-correlation
+             coefficients.
+    """
+    npair, nsamp = Y.shape
+    clag = np.empty(npair, dtype=np.int64)
+    ccmax = np.empty(npair, dtype=np.float32)
+    for ipair in range(npair):
+        y = Y[ipair] - np.float32(np.mean(Y[ipair]))
+        x = X[ipair] - np.float32(np.mean(X[ipair]))
+        norm = np.sqrt(np.sum(y*y) * np.sum(x*x))
+        if norm == 0:
+            norm = np.float32(1.)
+        _ccmax, _clag = np.float32(0.), -max_shift
+        for shift in range(-max_shift, max_shift+1):
+            acc = np.float32(0.)
+            for i in range(max(0, -shift), min(nsamp, nsamp-shift)):
+                acc += y[i+shift] * x[i]
+            if abs(acc) > abs(_ccmax):
+                _ccmax, _clag = acc, shift
+        clag[ipair] = _clag
+        ccmax[ipair] = _ccmax / norm
+    return(clag, ccmax)
+
+def correlate_pair(evid0, evidB, asdf_h5, event_index, phase_index, cfg,
+                   cache, templates, spectra):
     """
-    Correlate an event with its K nearest-neighbours.
+    Correlate an event with one of its nearest-neighbours.
 
     Arguments:
-    evid      :: int
-                 The event ID of the "control" or "template" event.
-    asdf_h5 :: pyasdf.ASDFDataSet
+    evid0     :: int
+                 The event ID of the primary ("control" or "template")
+                 event.
+    evidB     :: int
+                 The event ID of the secondary (neighbour) event.
+    asdf_h5 :: h5py.File
                  The waveform dataset. It is assumed that each waveform
                  is given a tag "event$EVID" where $EVID is the event ID
                  of the associated event. This tag format may change in
                  the future.
-    f5out     :: h5py.File
-                 The output data file where results will be stored. This
-                 file needs to be initialized with the proper metadata
-                 structure; this can be achieved with initialize_f5out().
-    df0_event :: pandas.DataFrame
-                 A DataFrame of all events in the dataset. The DataFrame
-                 must be indexed by event ID and the columns must be
-                 lat, lon, depth, and time.
-    df0_phase :: pandas.DataFrame
-                 A DataFrame of all phase information in the dataset. The
-                 DataFrame must be indexed by event ID and the columns must
-                 be arid, sta, chan, phase, time, prefor, and net.
+    event_index :: dict
+                 Index of all events in the dataset returned by
+                 build_event_index().
+    phase_index :: dict
+                 Index of all phase information in the dataset returned
+                 by build_phase_index().
+    cache     :: dict
+                 Waveform data for each station and event; may
+                 be shared by all pairs with the same primary event.
+    templates :: dict
+                 Filtered template windows (or None if the data do not
+                 cover the window) for each (event ID, network, station,
+                 channel, phase); may be shared by all pairs with the
+                 same primary event.
+    spectra   :: dict
+                 Template spectra, with the same keys as templates.
 
     Returns:
-    None
-    """
-    COMM = MPI.COMM_WORLD
-    # df_event :: DataFrame of K-nearest-neighbour events including
-    #             primary event.
-    # event0   :: primary event
-    # evid0    :: primary event ID
-    df_event = get_knn(evid, df0_event, k=cfg["knn"])
-    df_phase = get_phases(df_event.index, df0_phase)
-    event0 = df_event.iloc[0]
-    evid0 = event0.name
-    for evidB, eventB in df_event.iloc[1:].iterrows():
-        # log_tstart :: for logging elapsed time
-        # ot0        :: origin time of the primary event
-        # otB        :: origin time of the secondary event
-        # _df_phase  :: DataFrame with arrival data for the primary and
-        #               secondary events
-        # __df_phase ::
-        log_tstart = time.time()
-        _ncorr_a, _ncorr_s = 0, 0
-        ot0 = op.core.UTCDateTime(event0["time"])
-        otB = op.core.UTCDateTime(eventB["time"])
-
-        _df_phase = get_phases((evid0, evidB), df_phase=df_phase)
-        __df_phase = _df_phase.drop_duplicates(["sta", "phase"])
-
-        for _, arrival in __df_phase.iterrows():
-            # ddiff   :: array of double-difference measurements for
-            #            this station:phase pair
-            # ccmax   :: array of maximum cross-correlation
-            #            coefficients for this station:phase pair
-            # shift   :: for plotting
-            # st0     :: waveform Stream for primary event
-            # stB     :: waveform Stream for secondary event
-            ddiff, ccmax = [], []
-            try:
-                __t = time.time()
-                st0 = get_waveforms_for_reference(asdf_h5,
-                                                  "event%d" % evid0,
-                                                  arrival["net"],
-                                                  arrival["sta"])
-                logger.debug("waveform retrieval took %.5f seconds" % (time.time()-__t))
-                __t = time.time()
-                stB = get_waveforms_for_reference(asdf_h5,
-                                                  "event%d" % evidB,
-                                                  arrival["net"],
-                                                  arrival["sta"])
-                logger.debug("waveform retrieval took %.5f seconds" % (time.time()-__t))
-            except KeyError as err:
-                continue
-            # tr0 :: waveform Trace for primary event
-            # trB :: waveform Trace for secondary event
-            # trX :: "template" trace; this is ideally the primary event Trace,
-            #        but the secondary event Trace will be used if the only
-            #        arrival for this station:phase pair comes from the secondary
-            #        event
-            # trY :: "test" trace; this is ideally the secondary event Trace
-            # atX :: arrival-time of the template arrival
-            # otY :: origin-time of the "test" event
-            try:
-                for tr0 in st0:
-                    try:
-                        trB = stB.select(channel=tr0.stats.channel)[0]
-                    except IndexError as err:
-                        continue
-                    atX = op.core.UTCDateTime(arrival["time"])
-                    if arrival.name == evid0:
-                    # Do the calculation "forward".
-                    # This means that the primary (earlier) event is used as the template
-                    # trace.
-                        trX, trY     = tr0, trB
-                        otX, otY     = ot0, otB
-                        evidX, evidY = evid0, evidB
-                    else:
-                    # Do the calculation "backward".
-                    # This means that the secondary (later) event is used as the template
-                    # trace.
-                        trX, trY     = trB, tr0
-                        otX, otY     = otB, ot0
-                        evidX, evidY = evidB, evid0
-                    ttX = atX - otX
-                    atY = otY + ttX
-                    # filter the traces
-                    trX = trX.filter("bandpass",
-                                     freqmin=cfg["filter_fmin"],
-                                     freqmax=cfg["filter_fmax"])
-                    trY = trY.filter("bandpass",
-                                     freqmin=cfg["filter_fmin"],
-                                     freqmax=cfg["filter_fmax"])
-                    # slice the template trace
-                    trX = trX.slice(starttime=atX-cfg["tlead_%s" % arrival["phase"].lower()],
-                                    endtime  =atX+cfg["tlag_%s" % arrival["phase"].lower()])
-                    # slice the test trace
-                    trY = trY.slice(starttime=atY-cfg["tlead_%s" % arrival["phase"].lower()],
-                                    endtime  =atY+cfg["tlag_%s" % arrival["phase"].lower()])
-                    # error checking
-                    min_nsamp = int(
-                            (cfg["tlead_%s" % arrival["phase"].lower()]\
-                           + cfg["tlag_%s" % arrival["phase"].lower()]) \
-                           * trX.stats.sampling_rate
-                           )
-                    if len(trX) < min_nsamp or len(trY) < min_nsamp:
-                        logger.debug("len(trX), len(trY), min_nsamp: "\
-                                     "{:d}, {:d}, {:d}".format(len(trX),
-                                                               len(trY),
-                                                               min_nsamp))
-                        continue
-
-                    # max shift :: the maximum shift to apply when cross-correlating
-                    # corr      :: the cross-correlation time-series
-                    # clag      :: the lag of the maximum cross-correlation
-                    #              coefficient. 0 shift corresponds to the
-                    #              case below where both traces are center-
-                    #              aligned
-                    #          ---------|+++++++++
-                    #          9876543210123456789
-                    #     trX: -------XXXXX-------
-                    #     trY: YYYYYYYYYYYYYYYYYYY
-                    # _ccmax    :: the maximum cross-correlation coefficient
-                    # tshift    :: clag converted to units of time
-                    # t0X       :: the center time of trX
-                    # t0Y       :: the center time of trY
-                    ## iet      :: inter-event time
-                    ## iat      :: inter-arrival time
-                    ## _ddiff   :: double-difference (differential travel-time)
-                    # Do the actual correlation
-                    __t = time.time()
-                    max_shift     = int(len(trY)/2)
-                    corr          = op.signal.cross_correlation.correlate(trY,
-                                                                        trX,
-                                                                        max_shift)
-                    clag, _ccmax  = op.signal.cross_correlation.xcorr_max(corr)
-                    tshift        = clag * trY.stats.delta
-                    t0X           = np.mean([trX.stats.starttime.timestamp,
-                                            trX.stats.endtime.timestamp])
-                    t0Y           = np.mean([trY.stats.starttime.timestamp,
-                                            trY.stats.endtime.timestamp])
-                    _ddiff = tshift
-                    logger.debug("correlation tooks %.5f seconds" % (time.time() - __t))
-                    _ncorr_a += 1
-                    # store values if the correlation is high
-                    if abs(_ccmax) >= cfg["corr_min"]:
-                    #if _ccmax >= cfg["corr_min"]:
-                        _ncorr_s += 1
-                        ddiff.append(_ddiff)
-                        ccmax.append(_ccmax)
-            finally:
-                # if cross-correlation was successful, output best value
-                if len(ddiff) > 0:
-                    grpid = "{:d}/{:d}/{:s}".format(evid0,
-                                                    evidB,
-                                                    arrival["sta"])
-                    dsid = "{:s}/{:s}".format(grpid,
-                                              arrival["phase"])
-                    idxmax = np.argmax(np.abs(ccmax))
-                    ddiff = ddiff[idxmax]
-                    ccmax = ccmax[idxmax]
-                    logger.debug("{:s}: {:.2f}, {:.2f}".format(dsid,
-                                                               ddiff,
-                                                               ccmax))
-                    data = {"grpid": grpid,
-                            "dsid" : dsid,
-                            "ddiff": ddiff,
-                            "ccmax": ccmax,
-                            "chan" : arrival["chan"],
-                            "phase": arrival["phase"]}
-                else:
-                    data = None
-
-                __t = time.time()
-                COMM.send(data, WRITER_RANK)
-                logger.debug("writing took %.5f seconds" % (time.time() - __t))
-
-        logger.info("correlated event ID#{:d} with ID#{:d} - elapsed time: "\
-                    "{:6.2f} s, ncorr = ({:d}/{:d})".format(evid0,
-                                                            evidB,
-                                                            time.time()-log_tstart,
-                                                            _ncorr_s,
-                                                            _ncorr_a))
-
-def initialize_output(f5):
-    f5.create_dataset("evidA", (0,), maxshape=(None,), dtype="i")
-    f5.create_dataset("evidB", (0,), maxshape=(None,), dtype="i")
-    f5.create_dataset("sta", (0,), maxshape=(None,), dtype="S5")
-    f5.create_dataset("chan", (0,), maxshape=(None,), dtype="S6")
-    f5.create_dataset("phase", (0,), maxshape=(None,), dtype="S1")
-    f5.create_dataset("ddiff", (0,), maxshape=(None,), dtype="f")
-    f5.create_dataset("ccmax", (0,), maxshape=(None,), dtype="f")
-
-def write_loop(f5):
-    stop_count = 0
-    idx = 0
-    keys = ("evidA", "evidB", "sta", "phase", "chan", "ddiff", "ccmax")
-    while True:
-        if stop_count == SIZE-1:
-            return
-        data = COMM.recv()
-        if data is None:
-            continue
-        elif data is StopIteration:
-            stop_count += 1
+    A structured array (with dtype RESULT_DTYPE) of correlation results
+    with one entry per correlated station:phase pair.
+    """
+    # results :: correlation results
+    results = []
+    # tlead :: number of seconds before the arrival to correlate, by phase
+    # tlag  :: number of seconds after the arrival to correlate, by phase
+    tlead = dict((phase, cfg["tlead_%s" % phase.lower()]) for phase in "PSps")
+    tlag  = dict((phase, cfg["tlag_%s" % phase.lower()]) for phase in "PSps")
+    # log_tstart :: for logging elapsed time
+    # ot0        :: origin time of the primary event
+    # otB        :: origin time of the secondary event
+    # __phase    :: arrival data for the primary and secondary events,
+    #               with one arrival per station:phase pair
+    # net, sta, chan, phase, atime, aevid ::
+    #               columns of __phase; aevid is the event ID of the
+    #               arrival
+    log_tstart = time.time()
+    _ncorr_a, _ncorr_s = 0, 0
+    ot0, otB = event_index["time"][np.searchsorted(event_index["evid"],
+                                                   (evid0, evidB))]
+
+    # The columns are converted to lists once, so that the arrival loop
+    # indexes plain Python objects rather than boxing NumPy scalars.
+    __phase = get_phases((evid0, evidB), phase_index, unique=True)
+    net, sta, chan = (__phase[key].tolist() for key in ("net", "sta", "chan"))
+    phase, atime, aevid = (__phase[key].tolist() for key in ("phase",
+                                                             "time",
+                                                             "evid"))
+
+    # windows :: (k, trX, trY, delta, keyX) for each channel of each
+    #            arrival, where k is the position of the arrival in
+    #            __phase and keyX identifies the template window
+    windows = []
+    __t = time.time()
+    for k in range(len(__phase)):
+        # waves0  :: waveform data for primary event
+        # wavesB  :: waveform data for secondary event
+        waves0 = get_station_data(asdf_h5,
+                                  evid0,
+                                  net[k],
+                                  sta[k],
+                                  cache)
+        if len(waves0) == 0:
+        # Nothing to correlate the secondary event with at this station, so
+        # do not read its data.
             continue
+        wavesB = get_station_data(asdf_h5,
+                                  evidB,
+                                  net[k],
+                                  sta[k],
+                                  cache)
+        # wavesX :: "template" waveform data; this is ideally the primary
+        #           event data, but the secondary event data will be used
+        #           if the only arrival for this station:phase pair comes
+        #           from the secondary event
+        # wavesY :: "test" waveform data; this is ideally the secondary
+        #           event data
+        # atX    :: arrival-time of the template arrival
+        # otY    :: origin-time of the "test" event
+        # trX    :: template window
+        # trY    :: test window
+        # _tlead, _tlag :: window lead and lag for this phase
+        atX = atime[k]
+        if aevid[k] == evid0:
+        # Do the calculation "forward".
+        # This means that the primary (earlier) event is used as the template
+        # trace.
+            wavesX, wavesY = waves0, wavesB
+            otX, otY       = ot0, otB
         else:
-            if idx % OUTPUT_BLOCK_SIZE == 0:
-                for key in keys:
-                    f5[key].resize((f5[key].shape[0] + OUTPUT_BLOCK_SIZE,))
-            evidA, evidB, sta, phase = data["dsid"].split("/")
-            values = [int(evidA),
-                      int(evidB),
-                      sta.encode(),
-                      phase.encode(),
-                      data["chan"].encode(),
-                      data["ddiff"],
-                      data["ccmax"]]
-            for key, value in zip(keys, values):
-                f5[key][idx] = value
-            idx += 1
-
-def detect_python_version():
-    if sys.version_info.major != 2:
-        logger.error("Python2 is currently the only supported version of this"
-                     "code. Please use a Python2 interpreter.")
-        exit()
+        # Do the calculation "backward".
+        # This means that the secondary (later) event is used as the template
+        # trace.
+            wavesX, wavesY = wavesB, waves0
+            otX, otY       = otB, ot0
+        ttX = atX - otX
+        atY = otY + ttX
+        _tlead, _tlag = tlead[phase[k]], tlag[phase[k]]
+        for _chan in sorted(wavesX):
+            if _chan not in wavesY:
+                continue
+            # error checking
+            if wavesX[_chan][2] != wavesY[_chan][2]:
+                logger.debug("sampling rate mismatch for %s" % _chan)
+                continue
+            # The template window only depends on keyX, so it is only
+            # filtered once for all pairs with the same primary event.
+            keyX = (aevid[k], net[k], sta[k], _chan, phase[k])
+            if keyX not in templates:
+                templates[keyX] = get_window(wavesX[_chan],
+                                             atX,
+                                             _tlead,
+                                             _tlag,
+                                             cfg)
+            trX = templates[keyX]
+            trY = get_window(wavesY[_chan],
+                             atY,
+                             _tlead,
+                             _tlag,
+                             cfg) if trX is not None else None
+            if trX is None or trY is None:
+                logger.debug("insufficient data for %s" % _chan)
+                continue
+            windows.append((k, trX, trY, 1./wavesY[_chan][2], keyX))
+    logger.debug("waveform retrieval took %.5f seconds" % (time.time()-__t))
+
+    # max shift :: the maximum shift to apply when cross-correlating
+    # clag      :: the lag of the maximum cross-correlation
+    #              coefficient. 0 shift corresponds to the
+    #              case below where both traces are center-
+    #              aligned
+    #          ---------|+++++++++
+    #          9876543210123456789
+    #     trX: -------XXXXX-------
+    #     trY: YYYYYYYYYYYYYYYYYYY
+    # _ccmax    :: the maximum cross-correlation coefficient
+    ## iet      :: inter-event time
+    ## iat      :: inter-arrival time
+    ## _ddiff   :: double-difference (differential travel-time)
+    # batches   :: windows of all arrivals with the same sampling interval
+    #              and length, which are stacked and correlated together,
+    #              in the frequency domain for long windows and in the
+    #              time domain for short ones
+    # best      :: (_ddiff, _ccmax) of the channel with the highest
+    #              absolute correlation coefficient for each arrival
+    # Do the actual correlation
+    __t = time.time()
+    batches, best = {}, {}
+    for window in windows:
+        batches.setdefault((window[3], len(window[2])), []).append(window)
+    for (delta, nsamp), batch in batches.items():
+        Y = np.vstack([trY for _, _, trY, _, _ in batch])
+        if nsamp < FFT_MIN_NSAMP:
+            X = np.vstack([trX for _, trX, _, _, _ in batch])
+            clag, _ccmax = xcorr_direct(Y, X, int(nsamp/2))
+        else:
+            for _, trX, _, _, keyX in batch:
+                if keyX not in spectra:
+                    spectra[keyX] = template_spectrum(trX)
+            Xf, xnorm = zip(*[spectra[keyX] for _, _, _, _, keyX in batch])
+            clag, _ccmax = xcorr_fft(Y,
+                                     np.vstack(Xf),
+                                     np.array(xnorm),
+                                     int(nsamp/2))
+        for (k, _, _, _, _), _clag, _cc in zip(batch, clag, _ccmax):
+            _ncorr_a += 1
+            # store values if the correlation is high
+            if abs(_cc) >= cfg["corr_min"]:
+            #if _cc >= cfg["corr_min"]:
+                _ncorr_s += 1
+                if k not in best or abs(_cc) > abs(best[k][1]):
+                    best[k] = (_clag * delta, _cc)
+    logger.debug("correlation tooks %.5f seconds" % (time.time() - __t))
+
+    # store the best value of each successfully cross-correlated arrival
+    for k in sorted(best):
+        ddiff, ccmax = best[k]
+        dsid = "{:d}/{:d}/{:s}/{:s}".format(evid0,
+                                            evidB,
+                                            sta[k],
+                                            phase[k])
+        logger.debug("{:s}: {:.2f}, {:.2f}".format(dsid, ddiff, ccmax))
+        results.append((evid0,
+                        evidB,
+                        sta[k],
+                        chan[k],
+                        phase[k],
+                        ddiff,
+                        ccmax))
+
+    logger.info("correlated event ID#{:d} with ID#{:d} - elapsed time: "\
+                "{:6.2f} s, ncorr = ({:d}/{:d})".format(evid0,
+                                                        evidB,
+                                                        time.time()-log_tstart,
+                                                        _ncorr_s,
+                                                        _ncorr_a))
+    return(np.array(results, dtype=RESULT_DTYPE))
+
+def load_results(f5in):
+    """
+    Load the correlation results written by write_output().
+
+    f5in :: output HDF5 file of a previous run.
+
+    Returns:
+    A structured array (with dtype RESULT_DTYPE) of correlation results.
+    """
+    with h5py.File(f5in, "r") as f5:
+        results = np.empty(len(f5["evidA"]), dtype=RESULT_DTYPE)
+        for key in RESULT_DTYPE.names:
+            results[key] = f5[key][...]
+    return(results)
+
+def load_previous_results(f5in):
+    """
+    Load the results of a previous run from its output file and from the
+    checkpoint files it left behind if it was interrupted.
+
+    f5in :: output HDF5 file of a previous run. It need not exist if
+            checkpoint files for it do.
+
+    Returns:
+    results :: structured array (with dtype RESULT_DTYPE) of unique
+               correlation results.
+    pairs   :: 2-D int64 array of the unique event pairs that were
+               correlated, including pairs without any result.
+    """
+    checkpoints = sorted(glob.glob(f5in + ".*.partial"))
+    if not os.path.exists(f5in) and len(checkpoints) == 0:
+        raise(IOError("no results or checkpoint files found for %s" % f5in))
+    results = [load_results(f5in)] if os.path.exists(f5in) else []
+    pairs = [np.empty((0, 2), dtype=np.int64)]
+# A checkpoint file that was being written when the run was killed may be
+# unreadable; its pairs are simply correlated again.
+    for f5 in checkpoints:
+        try:
+            _results = load_results(f5)
+            with h5py.File(f5, "r") as _f5:
+                pairs.append(_f5["pairs"][...].astype(np.int64))
+            results.append(_results)
+        except (IOError, KeyError) as err:
+            logger.warning("skipping checkpoint file %s - %s" % (f5, err))
+    results = np.unique(np.concatenate(results)) if len(results) > 0\
+              else np.empty(0, dtype=RESULT_DTYPE)
+    pairs.append(np.column_stack([results["evidA"], results["evidB"]]))
+    return(results, np.unique(np.concatenate(pairs).astype(np.int64), axis=0))
+
+def start_checkpoints(outfile, checkpoint, results, pairs):
+    """
+    Remove the checkpoint files left behind for outfile by a previous run,
+    and start the checkpoint file of the manager-rank with results. The
+    new file replaces the old one in a single step, so that results
+    carried over from the old files are not lost if the run is killed.
+
+    outfile    :: name of the output HDF5 file.
+    checkpoint :: name of the checkpoint file of the manager-rank.
+    results    :: list of structured arrays (with dtype RESULT_DTYPE) of
+                  results to start it with.
+    pairs      :: list of 2-D int64 arrays of the event pairs that results
+                  came from.
+    """
+    stale = glob.glob(outfile + ".*.partial")
+    if len(results) > 0:
+        write_checkpoint(checkpoint + ".tmp", results, pairs, mode="w")
+        os.replace(checkpoint + ".tmp", checkpoint)
+    for f5 in stale:
+        if f5 != checkpoint or len(results) == 0:
+            os.remove(f5)
+
+def write_checkpoint(checkpoint, results, pairs, mode="a"):
+    """
+    Append correlation results to the checkpoint file of this rank. The
+    file is written with the default (serial) driver and has the same
+    datasets as the output file, so load_results() can read it. It also
+    has a pairs dataset with every event pair that was correlated, so
+    that pairs without any result are not correlated again on resume.
+
+    checkpoint :: name of the checkpoint file.
+    results    :: list of structured arrays (with dtype RESULT_DTYPE) of
+                  results.
+    pairs      :: list of 2-D int64 arrays of the event pairs that results
+                  came from.
+    mode       :: mode to open the file in; "w" starts a new file.
+    """
+    if len(results) == 0:
+        return
+    results, pairs = np.concatenate(results), np.concatenate(pairs)
+    with h5py.File(checkpoint, mode) as f5:
+        if "pairs" not in f5:
+            f5.create_dataset("pairs",
+                              (0, 2),
+                              dtype=np.int64,
+                              chunks=True,
+                              maxshape=(None, 2))
+        dset = f5["pairs"]
+        size = len(dset)
+        dset.resize((size+len(pairs), 2))
+        dset[size:] = pairs
+        for key in RESULT_DTYPE.names:
+            if key not in f5:
+                f5.create_dataset(key,
+                                  (0,),
+                                  dtype=RESULT_DTYPE[key],
+                                  chunks=True,
+                                  maxshape=(None,))
+            dset = f5[key]
+            size = len(dset)
+            dset.resize((size+len(results),))
+            dset[size:] = results[key]
+
+def initialize_output(f5, size, gzip_level=0):
+    """
+    Create the output datasets. This must be called collectively by
+    all ranks.
+
+    f5         :: h5py.File
+    size       :: total number of results.
+    gzip_level :: gzip compression level of the datasets; 0 for no
+                  compression. Only HDF5 1.10.2 and later can write
+                  compressed datasets in parallel.
+    """
+    compress = size > 0 and gzip_level > 0
+    if compress and h5py.version.hdf5_version_tuple < (1, 10, 2):
+        logger.warning("HDF5 %s cannot write compressed datasets in parallel; "
+                       "writing uncompressed output" % h5py.version.hdf5_version)
+        compress = False
+    for key in RESULT_DTYPE.names:
+        dtype = RESULT_DTYPE[key]
+        # All of the dataset's creation properties are set here, so that
+        # they are passed to HDF5 in one place.
+        dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+        if size > 0:
+            dcpl.set_chunk((min(size, OUTPUT_CHUNK_BYTES // dtype.itemsize),))
+        if compress:
+            dcpl.set_shuffle()
+            dcpl.set_deflate(gzip_level)
+        else:
+            # Parallel HDF5 allocates all space when the dataset is
+            # created; every element is written by write_output, so skip
+            # the fill-value pass. Parallel filtered writes are not
+            # combined with it.
+            dcpl.set_fill_time(h5py.h5d.FILL_TIME_NEVER)
+        h5py.h5d.create(f5.id,
+                        key.encode(),
+                        h5py.h5t.py_create(dtype),
+                        h5py.h5s.create_simple((size,)),
+                        dcpl=dcpl)
+
+def write_output(outfile, results, hints=None, gzip_level=0):
+    """
+    Write the correlation results of all ranks to a single output file.
+    This must be called collectively by all ranks; each rank writes its
+    results to a contiguous slab of every dataset using collective
+    MPI-IO.
+
+    outfile    :: name of the output HDF5 file.
+    results    :: structured array (with dtype RESULT_DTYPE) of results
+                  from this rank.
+    hints      :: dict of MPI-IO hints to open the output file with.
+    gzip_level :: gzip compression level of the output datasets; 0 for no
+                  compression.
+    """
+    counts = COMM.allgather(len(results))
+    offset = sum(counts[:RANK])
+    dxpl = h5py.h5p.create(h5py.h5p.DATASET_XFER)
+    dxpl.set_dxpl_mpio(h5py.h5fd.MPIO_COLLECTIVE)
+    info = MPI.Info.Create()
+    for key, value in (hints or {}).items():
+        info.Set(key, value)
+    fapl = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+    fapl.set_fapl_mpio(COMM, info)
+    # Align full (uncompressed) chunks with the file system stripes, and
+    # allocate metadata in blocks rather than piecemeal.
+    fapl.set_alignment(OUTPUT_CHUNK_BYTES, OUTPUT_CHUNK_BYTES)
+    fapl.set_meta_block_size(64 * 1024)
+    # All ranks make the same metadata calls here, so metadata can be read
+    # and written collectively where h5py exposes it (MPI builds of h5py 3
+    # and later).
+    if hasattr(fapl, "set_all_coll_metadata_ops"):
+        fapl.set_all_coll_metadata_ops(True)
+    if hasattr(fapl, "set_coll_metadata_write"):
+        fapl.set_coll_metadata_write(True)
+    try:
+        fid = h5py.h5f.create(os.fsencode(outfile), h5py.h5f.ACC_TRUNC, fapl=fapl)
+        with h5py.File(fid) as f5:
+            initialize_output(f5, sum(counts), gzip_level)
+            for key in RESULT_DTYPE.names:
+                write_slab(f5[key], offset, results[key], dxpl)
+    finally:
+        info.Free()
+
+def write_slab(dset, offset, data, dxpl):
+    """
+    Write data to a contiguous slab of a 1-D dataset.
+    Ranks without any data still take part in collective writes, but
+    select nothing.
+
+    dset   :: h5py.Dataset
+    offset :: index of the first element of the slab.
+    data   :: 1-D array of data to write.
+    dxpl   :: dataset transfer property list.
+    """
+    data = np.ascontiguousarray(data)
+    mspace = h5py.h5s.create_simple((max(len(data), 1),))
+    fspace = dset.id.get_space()
+    if len(data) == 0:
+        mspace.select_none()
+        fspace.select_none()
+    else:
+        fspace.select_hyperslab((offset,), (len(data),))
+    dset.id.write(mspace, fspace, data, dxpl=dxpl)
+
+# INTERRUPTED :: set when an interrupting signal is received. The rank then
+#                stops correlating, and all ranks still write out the
+#                results they have.
+INTERRUPTED = False
 
 def signal_handler(sig, frame):
-    raise(SystemError("Interrupting signal received... aborting"))
+    global INTERRUPTED
+    INTERRUPTED = True
 
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGCONT, signal_handler)
@@ -476,7 +1348,6 @@ if __name__ == "__main__":
     args = parse_args()
     cfg = parse_config(args.config_file)
     configure_logging(args.verbose, args.logfile)
-    detect_python_version()
     try:
         main(args, cfg)
     except Exception as err:
@@ -0,0 +1,118 @@
+"""
+Smoke tests for ddcc.py. They are run on a few MPI ranks, e.g.
+
+    mpirun -np 2 python tests/smoke.py
+
+and need an MPI-enabled build of h5py for test_write_output().
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import obspy as op
+import obspy.signal.cross_correlation
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import ddcc
+
+COMM, RANK, SIZE = ddcc.COMM, ddcc.RANK, ddcc.SIZE
+
+
+def make_results(n, first):
+    """
+    Make fake correlation results.
+
+    n     :: number of results.
+    first :: event ID of the first primary event.
+
+    Returns:
+    A structured array (with dtype RESULT_DTYPE) of results.
+    """
+    results = np.zeros(n, dtype=ddcc.RESULT_DTYPE)
+    results["evidA"] = np.arange(first, first+n)
+    results["evidB"] = results["evidA"] + 1
+    results["sta"] = "STA%d" % RANK
+    results["chan"] = "HHZ"
+    results["phase"] = "P"
+    results["ddiff"] = np.linspace(-1, 1, n)
+    results["ccmax"] = np.linspace(0, 1, n)
+    return(results)
+
+def test_xcorr():
+    """
+    Check xcorr_direct() and xcorr_fft() against ObsPy.
+    """
+    rng = np.random.RandomState(RANK)
+    for nsamp in (16, 101, 200):
+        max_shift = nsamp // 2
+        Y = rng.randn(4, nsamp).astype(np.float32)
+        X = rng.randn(4, nsamp).astype(np.float32)
+        X[0] = np.roll(Y[0], 3)
+        spectra, xnorm = zip(*[ddcc.template_spectrum(x) for x in X])
+        clag_fft, ccmax_fft = ddcc.xcorr_fft(Y,
+                                             np.vstack(spectra),
+                                             np.array(xnorm),
+                                             max_shift)
+        clag_dir, ccmax_dir = ddcc.xcorr_direct(Y, X, max_shift)
+        for i in range(len(Y)):
+            corr = op.signal.cross_correlation.correlate(Y[i], X[i], max_shift)
+            clag, ccmax = op.signal.cross_correlation.xcorr_max(corr)
+            assert clag_fft[i] == clag and clag_dir[i] == clag
+            assert np.isclose(ccmax_fft[i], ccmax, atol=1e-5)
+            assert np.isclose(ccmax_dir[i], ccmax, atol=1e-5)
+
+def test_checkpoints(tmpdir):
+    """
+    Check that load_previous_results() picks up the results and the
+    attempted pairs in the checkpoint files of every rank.
+
+    tmpdir :: directory shared by all ranks.
+    """
+    outfile = os.path.join(tmpdir, "checkpoint.h5")
+    results = make_results(3, 100*RANK)
+    pairs = np.column_stack([results["evidA"], results["evidB"]])
+    # A pair without any result.
+    pairs = np.vstack([pairs, [[100*RANK+50, 100*RANK+51]]])
+    ddcc.write_checkpoint("%s.%d.partial" % (outfile, RANK),
+                          [results[:1], results[1:]],
+                          [pairs[:1], pairs[1:]],
+                          mode="w")
+    COMM.Barrier()
+    previous, previous_pairs = ddcc.load_previous_results(outfile)
+    all_results = np.concatenate(COMM.allgather(results))
+    all_pairs = np.concatenate(COMM.allgather(pairs))
+    assert np.array_equal(previous, np.unique(all_results))
+    assert np.array_equal(previous_pairs, np.unique(all_pairs, axis=0))
+    COMM.Barrier()
+
+def test_write_output(tmpdir):
+    """
+    Check that write_output() writes the results of every rank, including
+    ranks without any, and that load_results() and
+    load_previous_results() read them back.
+
+    tmpdir :: directory shared by all ranks.
+    """
+    for gzip_level in (0, 4):
+        outfile = os.path.join(tmpdir, "output.%d.h5" % gzip_level)
+        results = make_results(5*RANK, 100*RANK)
+        ddcc.write_output(outfile, results, dict(ddcc.MPIIO_HINTS), gzip_level)
+        all_results = np.concatenate(COMM.allgather(results))
+        assert np.array_equal(ddcc.load_results(outfile), all_results)
+        previous, previous_pairs = ddcc.load_previous_results(outfile)
+        assert np.array_equal(previous, np.unique(all_results))
+        assert len(previous_pairs) == len(all_results)
+        COMM.Barrier()
+
+if __name__ == "__main__":
+# A failing rank exits with an error, which makes mpirun stop the others.
+    tmpdir = COMM.bcast(tempfile.mkdtemp() if RANK == 0 else None)
+    test_xcorr()
+    test_checkpoints(tmpdir)
+    test_write_output(tmpdir)
+    COMM.Barrier()
+    if RANK == 0:
+        shutil.rmtree(tmpdir)
+        print("all smoke tests passed on %d ranks" % SIZE)